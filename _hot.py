@@ -0,0 +1,12 @@
+# _hot.py
+"""
+Pure, fully typed helpers on the /search request path, kept free of dynamic features so the
+module can be compiled with mypyc (`mypyc _hot.py`); the plain Python module is used otherwise.
+"""
+
+from typing import List
+
+
+def build_prompt(chunks: List[str], query: str) -> str:
+    """Build the user message: the retrieved context as a bulleted list, then the question."""
+    return "Context:\n- " + "\n- ".join(chunks) + "\n\nQuestion: " + query
@@ -0,0 +1,29 @@
+"""Index documents.user_id
+
+Revision ID: 8f3c2a91d4b7
+Revises: 36d9691562e1
+Create Date: 2026-10-14 10:12:41.530214
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f3c2a91d4b7'
+down_revision: Union[str, Sequence[str], None] = '36d9691562e1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Per-user document lookups (search authorization, document listing)
+    op.create_index(op.f('ix_documents_user_id'), 'documents', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_documents_user_id'), table_name='documents')
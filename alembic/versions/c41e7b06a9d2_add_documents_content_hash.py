@@ -0,0 +1,31 @@
+"""Add documents.content_hash
+
+Revision ID: c41e7b06a9d2
+Revises: 8f3c2a91d4b7
+Create Date: 2026-10-14 11:03:17.204583
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41e7b06a9d2'
+down_revision: Union[str, Sequence[str], None] = '8f3c2a91d4b7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # SHA-256 of the uploaded bytes; NULL for documents uploaded before this migration
+    op.add_column('documents', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_documents_content_hash'), 'documents', ['content_hash'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_documents_content_hash'), table_name='documents')
+    op.drop_column('documents', 'content_hash')
@@ -4,58 +4,470 @@ Service for processing uploaded documents and managing the FAISS search index.
 """
 
 import os
-import json
+import fcntl
+import orjson
 import uuid
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import faiss
-from sentence_transformers import SentenceTransformer
-import pypdf
-from typing import List, Dict, Any
+from embedder import EMBEDDER, THREADS_PER_WORKER
+import pypdfium2 as pdfium
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
+
+# Split the cores between uvicorn worker processes so FAISS's OpenMP threads don't oversubscribe
+faiss.omp_set_num_threads(THREADS_PER_WORKER)
+
+# Chunk metadata is stored column-wise in Parquet, one row per FAISS vector id
+METADATA_SCHEMA = pa.schema([
+    ("document_id", pa.int32()),
+    ("page", pa.int32()),
+    ("chunk_index", pa.int32()),
+    ("pdf_name", pa.dictionary(pa.int32(), pa.string())),
+    ("content", pa.large_string()),
+])
+LEGACY_METADATA_PATH = "metadata.json"
+
+# Ingestion pipeline: page extraction feeds micro-batches of chunks to the encoder thread
+PIPELINE_BATCH_CHUNKS = 256
+ENCODE_BATCH_SIZE = 64
+
+# Exact FP32 embeddings are appended to a memory-mapped sidecar file that is only read to
+# re-rank candidates: the quantized first stage (SQ8 / PQ via FAISS_INDEX_FACTORY, or binary
+# below) returns RERANK_K candidates, which are re-scored by exact cosine.
+RERANK_K = 50
+
+# Scopes of up to this many vectors are scored exactly from the FP32 sidecar instead of searched
+# approximately: a filtered IVF / HNSW search can return fewer than k in-scope neighbours (or
+# none) when the scope is small, and brute force over a few thousand vectors is cheaper anyway.
+EXACT_SCOPE_SIZE = 4096
+
+# Optional binary first stage: sign-quantized 1-bit codes (48 bytes per 384-d vector) are
+# scanned by Hamming distance for BINARY_RECALL_K candidates instead of searching the FAISS
+# indexes. The binary index is rebuilt in memory at startup.
+BINARY_RECALL = os.getenv("BINARY_RECALL", "false").lower() == "true"
+BINARY_RECALL_K = 100
+
+# The main index type is a faiss index_factory string, e.g. "Flat", "HNSW32", "HNSW32,SQ8" or
+# "IVF4096,PQ64". "{nlist}" is replaced by sqrt(N) of the N vectors the index is trained on.
+# The default IVF-PQ index stores 16 bytes per vector (vs 1536 for FP32) and scans only
+# nprobe of its inverted lists per query. Changing it only affects newly created indexes.
+FAISS_INDEX_FACTORY = os.getenv("FAISS_INDEX_FACTORY", "IVF{nlist},PQ16")
+
+# HNSW / IVF search parameters (see faiss wiki "Indexing 1M vectors")
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 16
+
+# Indexes that need training (SQ, PQ, IVF) are trained on the first MIN_TRAIN_SIZE vectors, or
+# IVF_TRAIN_POINTS_PER_LIST per inverted list for IVF; vectors are held in an exact flat index until then.
+MIN_TRAIN_SIZE = 10_000
+IVF_TRAIN_POINTS_PER_LIST = 39
+
+# nlist is fixed when an IVF index is trained. Once the corpus outgrows it (N >= factor * nlist^2,
+# i.e. sqrt(N) has doubled) the main index is retrained from the exact FP32 vectors on up to
+# IVF_MAX_TRAIN_POINTS_PER_LIST sampled vectors per list, so each list stays ~sqrt(N) long.
+IVF_RETRAIN_FACTOR = 4
+IVF_MAX_TRAIN_POINTS_PER_LIST = 256
+REBUILD_ADD_BATCH = 65_536
+
+# New vectors go to a small in-memory delta index that is merged into the main index (and the
+# main index rewritten on disk) only once it holds DELTA_MERGE_SIZE vectors or on flush()
+DELTA_MERGE_SIZE = 5_000
+
+
+def create_index(dimension: int, num_train_vectors: int = MIN_TRAIN_SIZE) -> faiss.Index:
+    """Create an empty FAISS_INDEX_FACTORY index over normalized embeddings (cosine similarity)."""
+    factory = FAISS_INDEX_FACTORY.format(nlist=max(1, int(np.sqrt(num_train_vectors))))
+    index = faiss.index_factory(dimension, factory, faiss.METRIC_INNER_PRODUCT)
+    tune_index(index)
+    return index
+
+
+def tune_index(index: faiss.Index):
+    """Apply the HNSW / IVF search parameters to an index."""
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = IVF_NPROBE
+
+
+def stores_exact_vectors(index: faiss.Index) -> bool:
+    """Whether an index keeps the original FP32 vectors, so reconstruct() returns them exactly."""
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    return isinstance(index, (faiss.IndexFlat, faiss.IndexIVFFlat))
+
+
+def min_train_size(index: faiss.Index) -> int:
+    """Number of vectors to collect before training an index."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return max(MIN_TRAIN_SIZE, IVF_TRAIN_POINTS_PER_LIST * ivf.nlist)
+    return MIN_TRAIN_SIZE
+
+
+# The main index is opened memory-mapped and read-only, so uvicorn workers share the pages of
+# its vector codes through the OS page cache instead of each holding a private copy. For flat,
+# SQ and HNSW indexes that takes IO_FLAG_MMAP_IFC, which only exists in newer faiss releases.
+# IVF indexes can't be read with it: read_mapped_index() falls back to INDEX_MMAP_FLAGS_IVF,
+# which maps their inverted lists (OnDiskInvertedLists), while the coarse centroids and PQ
+# codebooks are small and loaded into each worker.
+INDEX_MMAP_FLAGS_IVF = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+INDEX_MMAP_FLAGS = INDEX_MMAP_FLAGS_IVF | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+
+def read_mapped_index(index_path: str) -> faiss.Index:
+    """Open an index file memory-mapped and read-only."""
+    try:
+        return faiss.read_index(index_path, INDEX_MMAP_FLAGS)
+    except RuntimeError:
+        if INDEX_MMAP_FLAGS == INDEX_MMAP_FLAGS_IVF:
+            raise
+        # "mmap only supported for File objects": IVF inverted lists need a plain file reader
+        return faiss.read_index(index_path, INDEX_MMAP_FLAGS_IVF)
+
+
+def write_index(index: faiss.Index, index_path: str):
+    """Write a FAISS index, replacing the file atomically."""
+    tmp_path = f"{index_path}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, index_path)
+
+
+def save_metadata(metadata: pa.Table, metadata_path: str):
+    """Write chunk metadata to Parquet, replacing the file atomically."""
+    tmp_path = f"{metadata_path}.tmp"
+    pq.write_table(metadata, tmp_path)
+    os.replace(tmp_path, metadata_path)
+
 
 class DocumentProcessor:
-    def __init__(self, index_path: str = "pdf_index.faiss", metadata_path: str = "metadata.json"):
+    def __init__(self, index_path: str = "pdf_index.faiss", metadata_path: str = "metadata.parquet"):
         self.index_path = index_path
         self.metadata_path = metadata_path
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+        self.delta_path = f"{os.path.splitext(index_path)[0]}.delta.faiss"
+        self.vectors_path = f"{os.path.splitext(index_path)[0]}.vectors.f32"
+        self.lock_path = f"{os.path.splitext(index_path)[0]}.lock"
+        self.model = EMBEDDER
+        # One processor is shared by all requests: FAISS indexes are not safe to search while
+        # vectors are being added, so index reads and mutations hold this lock (encoding does not)
+        self._lock = threading.RLock()
+        
+        with self._store_lock():
+            self._load()
+    
+    @contextmanager
+    def _store_lock(self):
+        """Hold an exclusive lock on the on-disk index files across processes (uvicorn workers)."""
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    @staticmethod
+    def _file_version(path: str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+    
+    def _disk_version(self):
+        """Identify the on-disk state; the metadata file is written last by every update."""
+        return self._file_version(self.metadata_path)
+    
+    def _load(self):
+        """Load all index state from disk. Call with the store lock held."""
+        # Load existing index and metadata if they exist. Vector ids [0, index.ntotal) live in
+        # the main index and the rest in the delta index, which holds recent additions that
+        # have not been merged into the main index yet.
+        self.index, self.delta, self.metadata = self._load_existing_index()
+        self.doc_to_ids = self._group_ids_by_document(self.metadata)
+        self.vectors = self._load_vectors()
+        self.bin_index = self._build_binary_index() if BINARY_RECALL else None
+        self._version = self._disk_version()
+        self._index_version = self._file_version(self.index_path)
+    
+    def _refresh(self):
+        """Reload the index if another worker process has updated it since it was last loaded."""
+        if self._disk_version() != self._version:
+            with self._store_lock():
+                self._sync()
+    
+    def _sync(self):
+        """Catch up with updates other workers have written since. Call with the store lock held.
         
-        # Load existing index and metadata if they exist
-        self.index, self.metadata = self._load_existing_index()
+        The main index file only changes when the delta is merged; until then other workers
+        only append chunks, so just their new rows are read.
+        """
+        if self._disk_version() == self._version:
+            return
+        if self._file_version(self.index_path) != self._index_version:
+            print("🔁 Main index updated by another worker, reloading")
+            self._load()
+            return
+        
+        metadata = self._load_metadata()
+        first_id = self.ntotal
+        num_new = metadata.num_rows - first_id
+        d = self.index.d
+        # The new chunks' exact vectors are the sidecar rows after ours, which are also the
+        # vectors the other worker appended to its (flat) delta index
+        new_vectors = np.fromfile(
+            self.vectors_path, dtype='float32', count=max(num_new, 0) * d, offset=first_id * d * 4
+        ).reshape(-1, d)
+        if num_new < 0 or len(new_vectors) != num_new:
+            print("🔁 Index updated by another worker, reloading")
+            self._load()
+            return
+        
+        self.delta.add(new_vectors)
+        self.vectors = self._map_vectors()
+        for document_id, ids in self._group_ids_by_document(metadata.slice(first_id)).items():
+            ids = ids + first_id
+            if document_id in self.doc_to_ids:
+                ids = np.concatenate([self.doc_to_ids[document_id], ids])
+            self.doc_to_ids[document_id] = ids
+        if self.bin_index is not None:
+            self.bin_index.add(np.packbits(new_vectors > 0, axis=1))
+        self.metadata = metadata
+        self._version = self._disk_version()
     
     def _load_existing_index(self):
-        """Load existing FAISS index and metadata, or create new ones."""
+        """Load existing FAISS indexes and metadata, or create new ones."""
+        # Default dimension (384 for all-MiniLM-L6-v2)
+        dimension = 384
         try:
-            index = faiss.read_index(self.index_path)
-            with open(self.metadata_path, 'r') as f:
-                metadata = json.load(f)
-            print(f"✅ Loaded existing index with {len(metadata)} chunks")
+            metadata = self._load_metadata()
+            # Either index file may be absent: the main index is first written on the first merge
+            self._index_mapped = os.path.exists(self.index_path)
+            if self._index_mapped:
+                index = read_mapped_index(self.index_path)
+            else:
+                index = create_index(dimension)
+            if os.path.exists(self.delta_path):
+                delta = faiss.read_index(self.delta_path)
+            else:
+                delta = faiss.IndexFlatIP(index.d)
+            print(f"✅ Loaded existing index with {metadata.num_rows} chunks")
         except FileNotFoundError:
             print("📝 Creating new FAISS index and metadata")
-            # Create new index with default dimension (384 for all-MiniLM-L6-v2)
-            dimension = 384
-            index = faiss.IndexFlatL2(dimension)
-            metadata = []
+            self._index_mapped = False
+            index = create_index(dimension)
+            delta = faiss.IndexFlatIP(dimension)
+            metadata = METADATA_SCHEMA.empty_table()
+        
+        if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            index, delta = self._migrate_index(index)
+        tune_index(index)
+        
+        # The metadata file is written last and is authoritative: delta vectors past it come
+        # from an update interrupted before its metadata was saved, and a delta the main index
+        # already covers is from a merge interrupted before the emptied delta was saved
+        num_delta_rows = metadata.num_rows - index.ntotal
+        if num_delta_rows < 0:
+            print(f"⚠️ Main index has {index.ntotal} vectors but metadata only {metadata.num_rows} chunks")
+        elif delta.ntotal > num_delta_rows:
+            print(f"⚠️ Dropping {delta.ntotal - num_delta_rows} delta vectors from an interrupted update")
+            delta.remove_ids(faiss.IDSelectorRange(num_delta_rows, delta.ntotal))
+        
+        return index, delta, metadata
+    
+    def _load_metadata(self) -> pa.Table:
+        """Read the Parquet metadata, converting a legacy JSON metadata file on first use."""
+        if os.path.exists(self.metadata_path):
+            return pq.read_table(self.metadata_path, schema=METADATA_SCHEMA, memory_map=True)
+        
+        with open(LEGACY_METADATA_PATH, 'rb') as f:
+            records = orjson.loads(f.read())
+        print(f"🔁 Converting {len(records)} chunks from {LEGACY_METADATA_PATH} to Parquet")
+        metadata = pa.Table.from_pylist(records, schema=METADATA_SCHEMA)
+        save_metadata(metadata, self.metadata_path)
+        return metadata
+    
+    @staticmethod
+    def _group_ids_by_document(metadata: pa.Table) -> Dict[int, np.ndarray]:
+        """Map each document_id to the FAISS vector ids (metadata row numbers) of its chunks."""
+        document_ids = metadata.column("document_id").fill_null(-1).to_numpy()
+        order = np.argsort(document_ids, kind="stable").astype('int64')
+        unique_ids, starts = np.unique(document_ids[order], return_index=True)
+        return {int(doc_id): ids for doc_id, ids in zip(unique_ids, np.split(order, starts[1:]))}
+    
+    def _migrate_index(self, old_index: faiss.Index) -> Tuple[faiss.Index, faiss.Index]:
+        """Rebuild a legacy L2 index as a FAISS_INDEX_FACTORY index over normalized vectors and persist it."""
+        print(f"🔁 Migrating {type(old_index).__name__} with {old_index.ntotal} vectors to {FAISS_INDEX_FACTORY}")
+        index = create_index(old_index.d)
+        delta = faiss.IndexFlatIP(old_index.d)
+        vectors = np.empty((0, old_index.d), dtype='float32')
+        if old_index.ntotal:
+            vectors = old_index.reconstruct_n(0, old_index.ntotal)
+            faiss.normalize_L2(vectors)
+            delta.add(vectors)
+        # Save the exact vectors before merging, or the sidecar would be rebuilt from quantized codes
+        self._write_vectors([vectors])
+        self.index, self.delta = index, delta
+        self._index_mapped = False
+        self._merge_delta()
+        write_index(self.index, self.index_path)
+        write_index(self.delta, self.delta_path)
+        return self.index, self.delta
+    
+    def _load_vectors(self) -> np.ndarray:
+        """Map the FP32 sidecar, rebuilding it from the indexes if it is missing or short.
+        
+        Rows past ntotal (left by an interrupted update) are ignored and overwritten by the next add.
+        """
+        if not (os.path.exists(self.vectors_path)
+                and os.path.getsize(self.vectors_path) >= self.ntotal * self.index.d * 4):
+            if self.index.ntotal and not stores_exact_vectors(self.index):
+                print(f"⚠️ WARNING: rebuilding the FP32 vectors file from a quantized {type(self.index).__name__}; "
+                      f"re-ranking will use approximate vectors until the documents are re-ingested")
+            print(f"🔁 Rebuilding FP32 vectors file from {self.ntotal} indexed vectors")
+            self._write_vectors(index.reconstruct_n(0, index.ntotal)
+                                for index in (self.index, self.delta) if index.ntotal)
+        return self._map_vectors()
+    
+    def _write_vectors(self, arrays: Iterable[np.ndarray]):
+        """Replace the FP32 sidecar with the given vectors, in order."""
+        # Write a new file and swap it in: other workers may have the old one mapped
+        tmp_path = f"{self.vectors_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for vectors in arrays:
+                vectors.tofile(f)
+        os.replace(tmp_path, self.vectors_path)
+    
+    def _map_vectors(self) -> np.ndarray:
+        if self.ntotal == 0:
+            return np.empty((0, self.index.d), dtype='float32')
+        return np.memmap(self.vectors_path, dtype='float32', mode='r', shape=(self.ntotal, self.index.d))
+    
+    def _build_binary_index(self) -> faiss.IndexBinaryFlat:
+        """Build the sign-bit index over all stored vectors, in global id order."""
+        bin_index = faiss.IndexBinaryFlat(self.index.d)
+        if self.ntotal:
+            bin_index.add(np.packbits(self.vectors > 0, axis=1))
+        return bin_index
+    
+    @property
+    def ntotal(self) -> int:
+        """Total number of vectors across the main and delta indexes."""
+        return self.index.ntotal + self.delta.ntotal
+    
+    def _add_vectors(self, embeddings: np.ndarray):
+        """Add vectors to the delta index and the FP32 sidecar."""
+        # Write at the row after the last indexed vector, overwriting rows left by an interrupted update
+        with open(self.vectors_path, "r+b" if os.path.exists(self.vectors_path) else "wb") as f:
+            f.seek(self.ntotal * self.index.d * 4)
+            f.truncate()
+            embeddings.tofile(f)
+        self.delta.add(embeddings)
+        self.vectors = self._map_vectors()
+    
+    def _should_merge(self) -> bool:
+        return self.delta.ntotal >= (DELTA_MERGE_SIZE if self.index.is_trained else min_train_size(self.index))
+    
+    def _merge_delta(self):
+        """Move the delta vectors into the main index and write it to disk.
+        
+        An index that needs training is trained on the buffered vectors first; until
+        min_train_size() vectors are available the delta keeps buffering.
+        """
+        if self.delta.ntotal == 0:
+            return
+        if not self.index.is_trained and self.delta.ntotal < min_train_size(self.index):
+            return
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if self.index.is_trained and ivf is not None and self.ntotal >= IVF_RETRAIN_FACTOR * ivf.nlist ** 2:
+            index = self._rebuild_index()
+        else:
+            vectors = self.delta.reconstruct_n(0, self.delta.ntotal)
+            # The mapped main index is read-only; load a private writable copy to add to
+            index = faiss.read_index(self.index_path) if self._index_mapped else self.index
+            if not index.is_trained:
+                # Recreate the index sized for the actual training set (nlist = sqrt(N))
+                index = create_index(index.d, len(vectors))
+                print(f"🎯 Training {FAISS_INDEX_FACTORY} index on {len(vectors)} vectors")
+                index.train(vectors)
+            print(f"🔀 Merging {len(vectors)} vectors into the main index")
+            index.add(vectors)
+        write_index(index, self.index_path)
+        self.delta.reset()
         
-        return index, metadata
+        # Swap in the mapping of the new file; os.replace keeps the old mapping valid meanwhile
+        self.index = read_mapped_index(self.index_path)
+        tune_index(self.index)
+        self._index_mapped = True
+        self._index_version = self._file_version(self.index_path)
+    
+    def _rebuild_index(self) -> faiss.Index:
+        """Train a new main index sized for all current vectors (nlist = sqrt(N)) and add them.
+        
+        Vectors come from the FP32 sidecar, which also holds the delta vectors.
+        """
+        index = create_index(self.index.d, self.ntotal)
+        nlist = faiss.try_extract_index_ivf(index).nlist
+        num_train = min(self.ntotal, IVF_MAX_TRAIN_POINTS_PER_LIST * nlist)
+        sample = np.sort(np.random.default_rng(0).choice(self.ntotal, num_train, replace=False))
+        print(f"🎯 Retraining {FAISS_INDEX_FACTORY} index with nlist={nlist} for {self.ntotal} vectors")
+        index.train(np.ascontiguousarray(self.vectors[sample]))
+        for start in range(0, self.ntotal, REBUILD_ADD_BATCH):
+            index.add(np.ascontiguousarray(self.vectors[start:start + REBUILD_ADD_BATCH]))
+        return index
+    
+    def flush(self):
+        """Merge pending delta vectors into the main index and save everything (e.g. on shutdown)."""
+        with self._lock, self._store_lock():
+            self._sync()
+            self._merge_delta()
+            self._save_index()
     
     def _chunk_text(self, text: str, chunk_size: int = 300, overlap: int = 50) -> List[str]:
         """Split text into chunks with overlap."""
         words = text.split()
-        if not words:
-            return []
-        
-        chunks = []
-        current_pos = 0
-        while current_pos < len(words):
-            start_pos = current_pos
-            end_pos = current_pos + chunk_size
-            chunk_words = words[start_pos:end_pos]
-            chunks.append(" ".join(chunk_words))
-            
-            current_pos += chunk_size - overlap
-            if current_pos >= len(words):
-                break
-                
-        return chunks
+        step = chunk_size - overlap
+        return [" ".join(words[start:start + chunk_size]) for start in range(0, len(words), step)]
+    
+    def _extract_pages(self, file_path: str, original_name: str) -> Iterator[Tuple[int, str]]:
+        """Yield (page_number, text) pairs in page order."""
+        if original_name.lower().endswith('.pdf'):
+            # PDFium is not thread-safe, so pages are extracted one at a time; its native
+            # calls release the GIL, which lets the encoder thread run in parallel
+            pdf = pdfium.PdfDocument(file_path)
+            try:
+                for page_num, page in enumerate(pdf, 1):
+                    textpage = page.get_textpage()
+                    text = textpage.get_text_range()
+                    textpage.close()
+                    page.close()
+                    yield page_num, text
+            finally:
+                pdf.close()
+        elif original_name.lower().endswith('.txt'):
+            with open(file_path, 'r', encoding='utf-8') as f:
+                yield 1, f.read()  # Text files are treated as single page
+    
+    def _encode(self, chunks: List[str]) -> np.ndarray:
+        """Encode chunks into normalized float32 embeddings."""
+        return self.model.encode(
+            chunks,
+            batch_size=ENCODE_BATCH_SIZE,
+            show_progress_bar=False,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+    
+    def embed_query(self, query: str) -> np.ndarray:
+        """Return the normalized (1, d) float32 embedding of a query."""
+        return self.model.encode([query], convert_to_numpy=True, normalize_embeddings=True)
     
     def process_document(self, file_path: str, document_id: int, original_name: str) -> Dict[str, Any]:
         """Process a document file (PDF or TXT) and add it to the search index."""
@@ -65,63 +477,56 @@ class DocumentProcessor:
         
         print(f"Processing document: {original_name}...")
         
-        # Extract text based on file type
+        # Extract text page by page and hand micro-batches of chunks to the
+        # encoder thread, so embedding overlaps with extraction of later pages
         all_chunks = []
         new_metadata = []
+        pending = []
+        batches = []
         
-        try:
-            if original_name.lower().endswith('.pdf'):
-                # Process PDF file
-                reader = pypdf.PdfReader(file_path)
-                for page_num, page in enumerate(reader.pages, 1):
-                    text = page.extract_text()
-                    if text:
-                        page_chunks = self._chunk_text(text)
-                        for chunk_index, chunk in enumerate(page_chunks):
-                            all_chunks.append(chunk)
-                            new_metadata.append({
-                                "document_id": document_id,
-                                "pdf_name": original_name,
-                                "page": page_num,
-                                "chunk_index": chunk_index,
-                                "content": chunk
-                            })
-            elif original_name.lower().endswith('.txt'):
-                # Process text file
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    text = f.read()
-                
-                if text:
-                    chunks = self._chunk_text(text)
-                    for chunk_index, chunk in enumerate(chunks):
+        with ThreadPoolExecutor(max_workers=1) as encoder:
+            try:
+                for page_num, text in self._extract_pages(file_path, original_name):
+                    if not text:
+                        continue
+                    page_chunks = self._chunk_text(text)
+                    for chunk_index, chunk in enumerate(page_chunks):
                         all_chunks.append(chunk)
                         new_metadata.append({
                             "document_id": document_id,
                             "pdf_name": original_name,
-                            "page": 1,  # Text files are treated as single page
+                            "page": page_num,
                             "chunk_index": chunk_index,
                             "content": chunk
                         })
-            
-            if not all_chunks:
-                raise ValueError("No text could be extracted from the document.")
+                    pending.extend(page_chunks)
+                    if len(pending) >= PIPELINE_BATCH_CHUNKS:
+                        batches.append(encoder.submit(self._encode, pending))
+                        pending = []
                 
-        except Exception as e:
-            raise Exception(f"Error reading or processing document: {e}")
-        
-        # Generate embeddings for new chunks
-        print(f"Generating embeddings for {len(all_chunks)} chunks...")
-        embeddings = self.model.encode(all_chunks, show_progress_bar=True, convert_to_tensor=False)
-        embeddings = np.array(embeddings).astype('float32')
-        
-        # Add new embeddings to existing index
-        self.index.add(embeddings)
-        
-        # Add new metadata
-        self.metadata.extend(new_metadata)
+                if not all_chunks:
+                    raise ValueError("No text could be extracted from the document.")
+                    
+            except Exception as e:
+                raise Exception(f"Error reading or processing document: {e}")
+            
+            if pending:
+                batches.append(encoder.submit(self._encode, pending))
+            
+            # Collect embeddings for new chunks into one contiguous array
+            print(f"Generating embeddings for {len(all_chunks)} chunks...")
+            embeddings = np.empty((len(all_chunks), self.index.d), dtype='float32')
+            offset = 0
+            for batch in batches:
+                batch_embeddings = batch.result()
+                embeddings[offset:offset + len(batch_embeddings)] = batch_embeddings
+                offset += len(batch_embeddings)
         
-        # Save updated index and metadata
-        self._save_index()
+        new_table = pa.Table.from_pylist(new_metadata, schema=METADATA_SCHEMA)
+        with self._lock, self._store_lock():
+            # Start from the latest on-disk state so other workers' additions are kept
+            self._sync()
+            self._append_chunks(document_id, embeddings, new_table)
         
         print(f"✅ Successfully processed {len(all_chunks)} chunks from {original_name}")
         
@@ -131,36 +536,192 @@ class DocumentProcessor:
             "document_id": document_id
         }
     
+    def copy_document(self, source_document_id: int, document_id: int, original_name: str) -> Optional[Dict[str, Any]]:
+        """Index a document with the same content as an indexed one by reusing its chunks and embeddings.
+        
+        Returns None if the source document is not in the index.
+        """
+        with self._lock, self._store_lock():
+            self._sync()
+            source_ids = self.doc_to_ids.get(source_document_id)
+            if source_ids is None:
+                return None
+            
+            embeddings = np.ascontiguousarray(self.vectors[source_ids])
+            rows = self.metadata.take(source_ids)
+            new_table = pa.Table.from_pydict({
+                "document_id": [document_id] * rows.num_rows,
+                "page": rows.column("page"),
+                "chunk_index": rows.column("chunk_index"),
+                "pdf_name": [original_name] * rows.num_rows,
+                "content": rows.column("content"),
+            }, schema=METADATA_SCHEMA)
+            self._append_chunks(document_id, embeddings, new_table)
+        
+        print(f"✅ Reused {rows.num_rows} chunks of document {source_document_id} for {original_name}")
+        
+        return {
+            "chunks_processed": rows.num_rows,
+            "pages_processed": len(pc.unique(rows.column("page"))),
+            "document_id": document_id
+        }
+    
+    def _append_chunks(self, document_id: int, embeddings: np.ndarray, new_table: pa.Table):
+        """Add a document's chunk embeddings and metadata and save them. Call with both locks held.
+        
+        If saving fails, the in-memory state is reloaded from disk, where the metadata file
+        (written last) still describes the previous state.
+        """
+        try:
+            # Add new embeddings to existing index; vector ids are assigned sequentially
+            first_id = self.ntotal
+            self._add_vectors(embeddings)
+            new_ids = np.arange(first_id, self.ntotal, dtype='int64')
+            if document_id in self.doc_to_ids:
+                new_ids = np.concatenate([self.doc_to_ids[document_id], new_ids])
+            self.doc_to_ids[document_id] = new_ids
+            if self.bin_index is not None:
+                self.bin_index.add(np.packbits(embeddings > 0, axis=1))
+            
+            # Add new metadata
+            self.metadata = pa.concat_tables([self.metadata, new_table])
+            
+            # Save updated index and metadata
+            self._save_index()
+        except Exception:
+            self._load()
+            raise
+        
+        # The chunks are saved; a failed merge leaves them buffered in the delta for the next attempt
+        if self._should_merge():
+            try:
+                self._merge_delta()
+                self._save_index()
+            except Exception as e:
+                print(f"⚠️ Merging the delta index failed, keeping it buffered: {e}")
+                self._load()
+    
     def _save_index(self):
-        """Save the current FAISS index and metadata."""
-        faiss.write_index(self.index, self.index_path)
-        with open(self.metadata_path, "w") as f:
-            json.dump(self.metadata, f)
-        print(f"💾 Saved index with {len(self.metadata)} total chunks")
+        """Save the delta index and metadata; the main index is only rewritten when the delta is merged."""
+        write_index(self.delta, self.delta_path)
+        save_metadata(self.metadata, self.metadata_path)
+        self._version = self._disk_version()
+        print(f"💾 Saved index with {self.metadata.num_rows} total chunks")
     
-    def search(self, query: str, document_id: int = None, k: int = 3) -> List[Dict[str, Any]]:
-        """Search for relevant chunks, optionally scoped to a specific document."""
+    def search(self, query: str, document_ids: List[int] = None, k: int = 3,
+               query_embedding: np.ndarray = None) -> List[Dict[str, Any]]:
+        """Search for relevant chunks, optionally scoped to a set of documents.
         
-        # Generate query embedding
-        query_embedding = self.model.encode([query])[0].astype('float32')
-        query_embedding = np.expand_dims(query_embedding, axis=0)
+        A precomputed normalized (1, d) query_embedding may be passed to skip encoding.
+        """
         
-        # Perform similarity search
-        distances, indices = self.index.search(query_embedding, k)
+        # Generate query embedding unless the caller (the API's QueryBatcher) already has it
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
         
-        # Filter results by document if specified
+        # Perform similarity search (inner product of normalized vectors = cosine, higher is better).
+        # When scoped to documents only their vectors are considered: small scopes are scored
+        # exactly, larger ones are searched by FAISS with an ID selector.
+        with self._lock:
+            self._refresh()
+            document_vector_ids = None
+            if document_ids is not None:
+                id_arrays = [self.doc_to_ids[doc_id] for doc_id in document_ids if doc_id in self.doc_to_ids]
+                if not id_arrays:
+                    return []
+                document_vector_ids = np.concatenate(id_arrays)
+            
+            if self.bin_index is not None:
+                ids, scores = self._search_binary(query_embedding, k, document_vector_ids)
+            else:
+                ids, scores = self._search_vectors(query_embedding, k, document_vector_ids)
+            
+            rows = self.metadata.take(ids)
         results = []
-        for i, idx in enumerate(indices[0]):
-            if idx < len(self.metadata):
-                chunk_info = self.metadata[idx]
-                
-                # If document_id is specified, only return chunks from that document
-                if document_id is None or chunk_info.get("document_id") == document_id:
-                    results.append({
-                        "content": chunk_info["content"],
-                        "pdf_name": chunk_info["pdf_name"],
-                        "page": chunk_info["page"],
-                        "distance": float(distances[0][i])
-                    })
+        for content, document_id, pdf_name, page, score in zip(
+            rows.column("content").to_pylist(),
+            rows.column("document_id").to_pylist(),
+            rows.column("pdf_name").to_pylist(),
+            rows.column("page").to_pylist(),
+            scores.tolist()
+        ):
+            results.append({
+                "content": content,
+                "document_id": document_id,
+                "pdf_name": pdf_name,
+                "page": page,
+                "score": score
+            })
         
         return results
+    
+    def _search_vectors(self, query_embedding: np.ndarray, k: int,
+                        selected_ids: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the main and delta indexes for candidates and re-rank them into one top-k (ids, scores)."""
+        if selected_ids is not None and len(selected_ids) <= EXACT_SCOPE_SIZE:
+            return self._rerank(selected_ids, query_embedding, k)
+        
+        num_candidates = max(k, RERANK_K)
+        _, main_ids = self._search_index(self.index, query_embedding, num_candidates, 0, selected_ids)
+        _, delta_ids = self._search_index(
+            self.delta, query_embedding, num_candidates, self.index.ntotal, selected_ids
+        )
+        
+        # Merge both candidate lists, dropping empty slots (-1) returned when fewer vectors are in scope
+        ids = np.concatenate([main_ids, delta_ids])
+        ids = ids[(ids >= 0) & (ids < self.metadata.num_rows)]
+        if selected_ids is not None and len(ids) < k:
+            # The probed lists / graph neighbourhood held too few in-scope vectors
+            return self._rerank(selected_ids, query_embedding, k)
+        return self._rerank(ids, query_embedding, k)
+    
+    def _rerank(self, ids: np.ndarray, query_embedding: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Score candidates by exact cosine on their FP32 vectors and keep the top k."""
+        scores = self.vectors[ids] @ query_embedding[0]
+        top = np.argsort(-scores, kind="stable")[:k]
+        return ids[top], scores[top]
+    
+    def _search_binary(self, query_embedding: np.ndarray, k: int,
+                       selected_ids: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Recall candidates by Hamming distance on sign bits, then re-rank them by cosine."""
+        if selected_ids is not None and len(selected_ids) <= EXACT_SCOPE_SIZE:
+            # Small scope: every in-scope vector can be re-ranked directly
+            candidates = selected_ids
+        else:
+            query_code = np.packbits(query_embedding > 0, axis=1)
+            if selected_ids is None:
+                _, indices = self.bin_index.search(query_code, BINARY_RECALL_K)
+            else:
+                selector = faiss.IDSelectorBatch(selected_ids)
+                params = faiss.SearchParameters(sel=selector)
+                _, indices = self.bin_index.search(query_code, BINARY_RECALL_K, params=params)
+            candidates = indices[0]
+        
+        candidates = candidates[(candidates >= 0) & (candidates < self.metadata.num_rows)]
+        return self._rerank(candidates, query_embedding, k)
+    
+    @staticmethod
+    def _search_index(index: faiss.Index, query_embedding: np.ndarray, k: int, id_offset: int,
+                      selected_ids: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Search one index, optionally restricted to global vector ids, returning global ids."""
+        if index.ntotal == 0:
+            return np.empty(0, dtype='float32'), np.empty(0, dtype='int64')
+        
+        if selected_ids is None:
+            scores, indices = index.search(query_embedding, k)
+        else:
+            local_ids = selected_ids[(selected_ids >= id_offset) & (selected_ids < id_offset + index.ntotal)]
+            if len(local_ids) == 0:
+                return np.empty(0, dtype='float32'), np.empty(0, dtype='int64')
+            selector = faiss.IDSelectorBatch(local_ids - id_offset)
+            # Search parameters override the index's own efSearch / nprobe, so pass them explicitly
+            if isinstance(index, faiss.IndexHNSW):
+                params = faiss.SearchParametersHNSW(sel=selector, efSearch=max(HNSW_EF_SEARCH, k))
+            elif isinstance(index, faiss.IndexIVF):
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=IVF_NPROBE)
+            else:
+                params = faiss.SearchParameters(sel=selector)
+            scores, indices = index.search(query_embedding, k, params=params)
+        
+        indices = indices[0]
+        return scores[0], np.where(indices >= 0, indices + id_offset, -1)
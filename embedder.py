@@ -0,0 +1,34 @@
+# embedder.py
+"""
+Process-wide sentence embedding model, shared by the API and the document service.
+"""
+
+import os
+import torch
+import onnxruntime
+from sentence_transformers import SentenceTransformer
+from export_model import EMBEDDING_MODEL_NAME, ONNX_MODEL_DIR, ONNX_MODEL_FILE
+
+# Split the cores between uvicorn worker processes so the encoder's (and FAISS's) thread
+# pools don't oversubscribe them
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", "1"))
+THREADS_PER_WORKER = max(1, (os.cpu_count() or 1) // UVICORN_WORKERS)
+torch.set_num_threads(THREADS_PER_WORKER)
+
+
+def load_embedding_model() -> SentenceTransformer:
+    """Load the int8 ONNX export of the embedding model, falling back to the PyTorch weights."""
+    if os.path.exists(os.path.join(ONNX_MODEL_DIR, ONNX_MODEL_FILE)):
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = THREADS_PER_WORKER
+        return SentenceTransformer(
+            ONNX_MODEL_DIR,
+            backend='onnx',
+            model_kwargs={'file_name': ONNX_MODEL_FILE, 'session_options': session_options}
+        )
+    print(f"⚠️ Quantized ONNX model not found in '{ONNX_MODEL_DIR}', run export_model.py; using PyTorch weights")
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+
+# Loaded once per process at import time
+EMBEDDER = load_embedding_model()
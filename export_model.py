@@ -0,0 +1,29 @@
+# export_model.py
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+import argparse
+import os
+
+# Embedding model: all-MiniLM-L6-v2, exported to int8-quantized ONNX by this script
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "./miniLM-int8-onnx")
+ONNX_MODEL_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+def export_model(output_dir: str, quantization_config: str = "avx512_vnni"):
+    """
+    Exports the embedding model to ONNX and writes a dynamically int8-quantized copy next to it.
+    """
+    print(f"Exporting {EMBEDDING_MODEL_NAME} to ONNX...")
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME, backend="onnx")
+    model.save(output_dir)
+
+    print(f"Quantizing to int8 ({quantization_config})...")
+    export_dynamic_quantized_onnx_model(model, quantization_config, output_dir)
+
+    print(f"\n✅ Quantized model saved to '{output_dir}'")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the embedding model to int8-quantized ONNX.")
+    parser.add_argument("--output_dir", type=str, default=ONNX_MODEL_DIR, help="Directory to write the model to.")
+    args = parser.parse_args()
+
+    export_model(args.output_dir)
@@ -1,32 +1,18 @@
 # ingestion.py
-import numpy as np
 import faiss
-from sentence_transformers import SentenceTransformer
-import json
-import pypdf
+import pypdfium2 as pdfium
 import argparse
 import os
+import pyarrow as pa
+from embedder import EMBEDDER
+from document_service import ENCODE_BATCH_SIZE, METADATA_SCHEMA, create_index, min_train_size, save_metadata
 
 # --- Helper function for chunking text ---
 def chunk_text(text, chunk_size=300, overlap=50):
     """Splits text into chunks of a specified size with overlap."""
     words = text.split()
-    if not words:
-        return []
-    
-    chunks = []
-    current_pos = 0
-    while current_pos < len(words):
-        start_pos = current_pos
-        end_pos = current_pos + chunk_size
-        chunk_words = words[start_pos:end_pos]
-        chunks.append(" ".join(chunk_words))
-        
-        current_pos += chunk_size - overlap
-        if current_pos >= len(words):
-            break
-            
-    return chunks
+    step = chunk_size - overlap
+    return [" ".join(words[start:start + chunk_size]) for start in range(0, len(words), step)]
 
 # --- Main Ingestion Logic ---
 def process_pdf(pdf_path: str):
@@ -42,22 +28,29 @@ def process_pdf(pdf_path: str):
     
     # 1. Extract Text from PDF
     try:
-        reader = pypdf.PdfReader(pdf_path)
+        pdf = pdfium.PdfDocument(pdf_path)
         all_chunks = []
         all_metadata = []
 
-        for page_num, page in enumerate(reader.pages, 1):
-            text = page.extract_text()
+        for page_num, page in enumerate(pdf, 1):
+            textpage = page.get_textpage()
+            text = textpage.get_text_range()
+            textpage.close()
+            page.close()
             if text:
                 page_chunks = chunk_text(text)
-                for chunk in page_chunks:
+                for chunk_index, chunk in enumerate(page_chunks):
                     all_chunks.append(chunk)
                     all_metadata.append({
-                        "pdf_id": pdf_filename,
+                        "document_id": None,  # Not tied to an uploaded document
+                        "pdf_name": pdf_filename,
                         "page": page_num,
+                        "chunk_index": chunk_index,
                         "content": chunk
                     })
         
+        pdf.close()
+
         if not all_chunks:
             print("Warning: No text could be extracted from the PDF.")
             return
@@ -66,28 +59,44 @@ def process_pdf(pdf_path: str):
         print(f"Error reading or processing PDF: {e}")
         return
 
-    # 2. Initialize Embedding Model
-    print("Loading embedding model...")
-    model = SentenceTransformer('all-MiniLM-L6-v2') 
+    # 2. Initialize Embedding Model (loaded once at import by embedder.py)
+    model = EMBEDDER
 
     # 3. Generate Embeddings
     print(f"Generating embeddings for {len(all_chunks)} chunks...")
-    embeddings = model.encode(all_chunks, show_progress_bar=True, convert_to_tensor=False)
-    embeddings = np.array(embeddings).astype('float32')
+    embeddings = model.encode(
+        all_chunks,
+        batch_size=ENCODE_BATCH_SIZE,
+        show_progress_bar=True,
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    )
 
     # 4. Build and Save FAISS Index
     print("Building FAISS index...")
     dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
+    index = create_index(dimension, len(embeddings))
 
-    # Save the index and metadata
-    faiss.write_index(index, "pdf_index.faiss")
-    with open("metadata.json", "w") as f:
-        json.dump(all_metadata, f)
+    # Save the index and metadata. Like DocumentProcessor, an index that needs more training
+    # data than this PDF provides stays empty and the vectors go to the exact delta index.
+    if index.is_trained or len(embeddings) >= min_train_size(index):
+        if not index.is_trained:
+            index.train(embeddings)
+        index.add(embeddings)
+        faiss.write_index(index, "pdf_index.faiss")
+        if os.path.exists("pdf_index.delta.faiss"):
+            os.remove("pdf_index.delta.faiss")  # Stale vectors from the previous index
+    else:
+        delta = faiss.IndexFlatIP(dimension)
+        delta.add(embeddings)
+        faiss.write_index(delta, "pdf_index.delta.faiss")
+        if os.path.exists("pdf_index.faiss"):
+            os.remove("pdf_index.faiss")  # Stale vectors from the previous index
+    embeddings.tofile("pdf_index.vectors.f32")  # Exact vectors used for re-ranking
+    save_metadata(pa.Table.from_pylist(all_metadata, schema=METADATA_SCHEMA), "metadata.parquet")
 
     print("\n✅ Ingestion complete!")
-    print("'pdf_index.faiss' and 'metadata.json' have been updated with your PDF content.")
+    print("'pdf_index.faiss' and 'metadata.parquet' have been updated with your PDF content.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process a PDF to create a searchable index.")
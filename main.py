@@ -1,35 +1,59 @@
 # main.py
+import asyncio
+import threading
 import uvicorn
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 import faiss
-from sentence_transformers import SentenceTransformer
 import numpy as np
-import json
+import orjson
 import os
-import shutil
-from openai import OpenAI
+import hashlib
+from openai import APIConnectionError, AsyncOpenAI, OpenAIError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 import dotenv
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload
 from database import get_db
 from models import User, Document
 from auth import authenticate_user, create_access_token, verify_token, get_password_hash
 from document_service import DocumentProcessor
+from semantic_cache import SemanticCache
+from query_batcher import QueryBatcher
+from _hot import build_prompt
 dotenv.load_dotenv()
 
 # --- Configuration ---
 # In a real app, use environment variables for secrets
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") # Replace with your key
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Retries are handled by _create_completion, so the client doesn't retry on its own as well
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+# At most this many completion requests are in flight to OpenAI per worker
+LLM_MAX_CONCURRENCY = 16
+llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+# Instructions sent as a fixed system message, so the provider can reuse its cached prompt prefix
+SYSTEM_PROMPT = (
+    "Based on the following context from a document, please answer the user's question.\n"
+    "If the context does not contain the answer, say 'The document does not provide information on this topic.'"
+)
 
 # --- App Initialization ---
-app = FastAPI(title="PDF Search API")
+# Responses carry lists of retrieved chunks, so serialize them with orjson
+app = FastAPI(title="PDF Search API", default_response_class=ORJSONResponse)
 
 # --- Models (Data Schemas) ---
 class SearchQuery(BaseModel):
     query: str
-    pdf_id: str # To scope search to a specific PDF
+    pdf_id: Optional[int] = None # To scope search to a specific PDF
+    stream: bool = False # Stream the answer as server-sent events instead of returning JSON
     
 class Token(BaseModel):
     access_token: str
@@ -44,8 +68,19 @@ class UserCreate(BaseModel):
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # --- Load Search Index and Model (at startup) ---
-# Note: FAISS index is now loaded dynamically by DocumentProcessor when needed
-print("✅ PDF Search API initialized - FAISS index will be loaded on first use")
+# A single DocumentProcessor (FAISS index + metadata) is shared by all requests
+@app.on_event("startup")
+async def load_document_processor():
+    app.state.processor = await run_in_threadpool(DocumentProcessor)
+    app.state.answer_cache = SemanticCache(app.state.processor.index.d)
+    app.state.query_batcher = QueryBatcher()
+    print("✅ PDF Search API initialized - FAISS index loaded")
+
+@app.on_event("shutdown")
+async def flush_document_processor():
+    await app.state.query_batcher.close()
+    # Merge buffered vectors into the main index so the next start loads them from it
+    await run_in_threadpool(app.state.processor.flush)
 
 # --- API Endpoints ---
 @app.post("/token", response_model=Token)
@@ -53,7 +88,8 @@ async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: Session = Depends(get_db)
 ):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    # Password hashing is deliberately slow, so keep it off the event loop
+    user = await run_in_threadpool(authenticate_user, db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -61,23 +97,21 @@ async def login_for_access_token(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    access_token = create_access_token(data={"sub": user.username})
+    access_token = create_access_token(data={"sub": user.username, "uid": user.id})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/register", response_model=Token)
 async def register_user(user_data: UserCreate, db: Session = Depends(get_db)):
-    # Check if user already exists
-    existing_user = db.query(User).filter(
-        (User.username == user_data.username) | (User.email == user_data.email)
-    ).first()
-    if existing_user:
+    # Check if user already exists (two unique-index probes; an OR of both may not use either index)
+    username_taken = db.query(db.query(User.id).filter(User.username == user_data.username).exists()).scalar()
+    if username_taken or db.query(db.query(User.id).filter(User.email == user_data.email).exists()).scalar():
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username or email already registered"
         )
     
     # Create new user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await run_in_threadpool(get_password_hash, user_data.password)
     new_user = User(
         username=user_data.username,
         email=user_data.email,
@@ -85,70 +119,159 @@ async def register_user(user_data: UserCreate, db: Session = Depends(get_db)):
     )
     
     db.add(new_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # Registered concurrently between the check and the insert
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username or email already registered"
+        )
     db.refresh(new_user)
     
     # Return token for immediate login
-    access_token = create_access_token(data={"sub": new_user.username})
+    access_token = create_access_token(data={"sub": new_user.username, "uid": new_user.id})
     return {"access_token": access_token, "token_type": "bearer"}
 
+# Document ids owned by each user, so hot searches skip the database. Each worker keeps its own
+# copy, which can miss a document uploaded through another worker: unscoped searches pick it
+# up within the TTL, and a scoped search reloads the entry before denying access.
+_user_documents_cache = TTLCache(maxsize=10_000, ttl=60)
+_user_documents_lock = threading.Lock()
+
+@cached(_user_documents_cache, key=lambda db, user_id: hashkey(user_id), lock=_user_documents_lock)
+def _user_document_ids(db: Session, user_id: int) -> frozenset:
+    """Return the ids of all documents owned by a user."""
+    return frozenset(doc_id for doc_id, in db.query(Document.id).filter(Document.user_id == user_id))
+
+def _invalidate_user_documents(user_id: int):
+    with _user_documents_lock:
+        _user_documents_cache.pop(hashkey(user_id), None)
+
+def _authorize_search(db: Session, user_id: int, document_id: Optional[int]) -> List[int]:
+    """Return the ids of the user's documents in scope, checking ownership of a scoped document."""
+    user_document_ids = _user_document_ids(db, user_id)
+    
+    # Verify the user has access to the specified document
+    if document_id is not None:
+        if document_id not in user_document_ids:
+            # The cached set may predate an upload handled by another worker; only deny on a fresh miss
+            _invalidate_user_documents(user_id)
+            user_document_ids = _user_document_ids(db, user_id)
+        if document_id not in user_document_ids:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="You don't have access to this document"
+            )
+        return [document_id]
+    
+    return sorted(user_document_ids)
+
+def _retrieve(query: str, document_ids: List[int], query_embedding: np.ndarray) -> List[Dict[str, Any]]:
+    """Search the index with an embedded query, restricted to the given documents."""
+    return app.state.processor.search(query, document_ids=document_ids, query_embedding=query_embedding)
+
+# Rate limits and dropped connections are retried with jittered exponential backoff
+_retry_llm = retry(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError)),
+    wait=wait_exponential_jitter(1, 10),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+
+@_retry_llm
+async def _create_completion(**kwargs):
+    """Create a chat completion, bounded by llm_semaphore and retried with backoff when rate limited.
+
+    The backoff sleeps outside the semaphore, so waiting retries don't hold a slot.
+    """
+    async with llm_semaphore:
+        return await client.chat.completions.create(**kwargs)
+
+@_retry_llm
+async def _open_stream(**kwargs):
+    """Open a streamed chat completion, returning it with an llm_semaphore slot held for the caller to release."""
+    await llm_semaphore.acquire()
+    try:
+        return await client.chat.completions.create(stream=True, **kwargs)
+    except BaseException:
+        llm_semaphore.release()
+        raise
+
+def _sse_error(detail: str) -> str:
+    return f"event: error\ndata: {orjson.dumps({'detail': detail}).decode()}\n\n"
+
+async def _stream_answer(completion_kwargs: Dict[str, Any], on_complete: Callable[[str], None]) -> AsyncIterator[str]:
+    """Stream an OpenAI chat completion as server-sent events, then pass on the full answer.
+
+    Each event carries a JSON-encoded text delta (so newlines survive the framing), and the
+    stream ends with a `[DONE]` event. The llm_semaphore slot is held until generation ends,
+    and an OpenAI error is reported as an `error` event before `[DONE]`.
+    """
+    try:
+        stream = await _open_stream(**completion_kwargs)
+    except RateLimitError:
+        yield _sse_error("The language model is rate limited, please retry shortly")
+        yield "data: [DONE]\n\n"
+        return
+    except OpenAIError as e:
+        yield _sse_error(f"Error contacting LLM: {str(e)}")
+        yield "data: [DONE]\n\n"
+        return
+    
+    parts = []
+    try:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield f"data: {orjson.dumps(chunk.choices[0].delta.content).decode()}\n\n"
+    except OpenAIError as e:
+        yield _sse_error(f"Error contacting LLM: {str(e)}")
+        yield "data: [DONE]\n\n"
+        return
+    finally:
+        # Also runs when the client disconnects and the response closes this generator
+        await stream.close()
+        llm_semaphore.release()
+    yield "data: [DONE]\n\n"
+    on_complete("".join(parts))
+
 @app.post("/search")
 async def search_pdf(
     request: SearchQuery, 
     token: str = Depends(oauth2_scheme),
     db: Session = Depends(get_db)
 ):
-    # Verify the token and get the username
-    username = verify_token(token)
-    if not username:
+    # Verify the token; the user id it carries saves a user lookup per search
+    token_data = verify_token(token)
+    if not token_data:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    username, user_id = token_data
+    document_id = request.pdf_id
     
-    # Verify user exists in database
-    user = db.query(User).filter(User.username == username).first()
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="User not found",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    
-    # Verify the user has access to the specified document
-    if request.pdf_id:
-        try:
-            document_id = int(request.pdf_id)
-            document = db.query(Document).filter(
-                Document.id == document_id,
-                Document.user_id == user.id
-            ).first()
-            if not document:
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail="You don't have access to this document"
-                )
-        except ValueError:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid document ID"
-            )
-    
-    # Use DocumentProcessor for search
     try:
-        processor = DocumentProcessor()
+        # Check access and embed the query (batched with concurrent requests) concurrently
+        user_document_ids, query_embedding = await asyncio.gather(
+            run_in_threadpool(_authorize_search, db, user_id, document_id),
+            app.state.query_batcher.encode(request.query),
+        )
         
-        # Search within specific document if pdf_id is provided
-        if request.pdf_id:
-            search_results = processor.search(request.query, document_id=int(request.pdf_id))
-        else:
-            # Search across all user's documents
-            search_results = processor.search(request.query)
-            # Filter results to only include user's documents
-            user_document_ids = [doc.id for doc in user.documents]
-            search_results = [result for result in search_results 
-                           if any(doc_id in result.get('pdf_name', '') for doc_id in user_document_ids)]
+        # Serve repeated or paraphrased questions from the answer cache
+        answer_cache = app.state.answer_cache
+        # The scope names the exact documents searched, so answers cached before an upload (by
+        # this or any other worker) stop matching once the user's document set changes
+        cache_scope = (user_id, tuple(user_document_ids))
+        cached = answer_cache.get(cache_scope, request.query, query_embedding)
+        if cached is not None:
+            return {"query": request.query, **cached}
+        
+        # The search only visits vectors of documents in scope, so no post-filtering is needed
+        search_results = await run_in_threadpool(_retrieve, request.query, user_document_ids, query_embedding)
         
         if not search_results:
             return {
@@ -159,28 +282,43 @@ async def search_pdf(
         
         # Extract context from search results
         retrieved_chunks = [result['content'] for result in search_results]
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": build_prompt(retrieved_chunks, request.query)},
+        ]
+        
+        def cache_answer(answer: str):
+            answer_cache.add(cache_scope, request.query, query_embedding, {
+                "answer": answer.strip(),
+                "retrieved_context": retrieved_chunks,
+                "search_results": search_results
+            })
         
         # Generate answer using OpenAI
         try:
-            prompt = f"""
-            Based on the following context from a document, please answer the user's question.
-            If the context does not contain the answer, say 'The document does not provide information on this topic.'
-
-            Context:
-            - {"\n- ".join(retrieved_chunks)}
-
-            Question: {request.query}
-
-            Answer:
-            """
+            if request.stream:
+                # Stream tokens to the client as they are generated; cached answers above stay plain JSON.
+                # The completion is opened by the response body, so errors arrive as SSE events.
+                completion_kwargs = {"model": "gpt-3.5-turbo", "messages": messages, "temperature": 0.0}
+                return StreamingResponse(
+                    _stream_answer(completion_kwargs, cache_answer),
+                    media_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                )
             
-            response = client.chat.completions.create(
+            response = await _create_completion(
                 model="gpt-3.5-turbo",
-                messages=[{"role": "system", "content": prompt}],
+                messages=messages,
                 temperature=0.0,
             )
             answer = response.choices[0].message.content
+            cache_answer(answer)
 
+        except RateLimitError:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="The language model is rate limited, please retry shortly"
+            )
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error contacting LLM: {str(e)}")
 
@@ -191,6 +329,8 @@ async def search_pdf(
             "search_results": search_results
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during search: {str(e)}")
 
@@ -202,16 +342,17 @@ async def list_user_documents(
     """List all documents uploaded by the authenticated user."""
     
     # Verify the token and get the username
-    username = verify_token(token)
-    if not username:
+    token_data = verify_token(token)
+    if not token_data:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    username, user_id = token_data
     
-    # Verify user exists in database
-    user = db.query(User).filter(User.username == username).first()
+    # Verify user exists in database, loading their documents in the same query
+    user = db.query(User).options(joinedload(User.documents)).filter(User.username == username).first()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -220,7 +361,7 @@ async def list_user_documents(
         )
     
     # Get user's documents
-    documents = db.query(Document).filter(Document.user_id == user.id).all()
+    documents = user.documents
     
     return {
         "documents": [
@@ -234,6 +375,27 @@ async def list_user_documents(
         ]
     }
 
+def _save_upload(source, file_path: str) -> Tuple[int, str]:
+    """Copy an uploaded file to disk, returning its size and SHA-256 hex digest from the same pass."""
+    digest = hashlib.sha256()
+    size = 0
+    source.seek(0)
+    with open(file_path, "wb") as dest:
+        while chunk := source.read(1 << 20):
+            dest.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+def _index_upload(document: Document, file_path: str, source_document_ids: List[int]) -> Dict[str, Any]:
+    """Index an uploaded document, reusing the embeddings of an identical indexed upload if there is one."""
+    processor = app.state.processor
+    for source_document_id in source_document_ids:
+        result = processor.copy_document(source_document_id, document.id, document.original_name)
+        if result is not None:
+            return result
+    return processor.process_document(file_path, document.id, document.original_name)
+
 @app.post("/upload")
 async def upload_document(
     file: UploadFile = File(...),
@@ -243,13 +405,14 @@ async def upload_document(
     """Upload a PDF document and process it for search."""
     
     # Verify the token and get the username
-    username = verify_token(token)
-    if not username:
+    token_data = verify_token(token)
+    if not token_data:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    username, user_id = token_data
     
     # Verify user exists in database
     user = db.query(User).filter(User.username == username).first()
@@ -281,29 +444,45 @@ async def upload_document(
         unique_filename = f"{uuid.uuid4()}{file_extension}"
         file_path = os.path.join("uploads", unique_filename)
         
-        # Save file to uploads directory
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Save file to uploads directory without blocking the event loop
+        file_size, content_hash = await run_in_threadpool(_save_upload, file.file, file_path)
         
-        # Get file size
-        file_size = os.path.getsize(file_path)
+        # The same file uploaded again by this user is the same document
+        existing = db.query(Document).filter(
+            Document.user_id == user.id,
+            Document.content_hash == content_hash
+        ).first()
+        if existing:
+            os.remove(file_path)
+            return {
+                "message": "Document already uploaded",
+                "document_id": existing.id,
+                "filename": existing.original_name,
+                "status": "duplicate"
+            }
+        # Identical uploads by other users whose embeddings can be reused
+        source_document_ids = [doc_id for doc_id, in db.query(Document.id).filter(
+            Document.content_hash == content_hash
+        )]
         
         # Create document record in database
         document = Document(
             filename=unique_filename,
             original_name=file.filename,
             user_id=user.id,
-            file_size=file_size
+            file_size=file_size,
+            content_hash=content_hash
         )
         db.add(document)
         db.commit()
         db.refresh(document)
+        _invalidate_user_documents(user.id)
         
         # Process the document and update search index
         try:
-            processor = DocumentProcessor()
-            processing_result = processor.process_document(file_path, document.id, document.original_name)
-            
+            processing_result = await run_in_threadpool(
+                _index_upload, document, file_path, source_document_ids
+            )
             return {
                 "message": "Document uploaded and processed successfully",
                 "document_id": document.id,
@@ -315,6 +494,7 @@ async def upload_document(
             # If processing fails, delete the document record and file
             db.delete(document)
             db.commit()
+            _invalidate_user_documents(user.id)
             if os.path.exists(file_path):
                 os.remove(file_path)
             raise HTTPException(
@@ -332,4 +512,8 @@ async def upload_document(
         )
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Each worker process loads its own model and index in the startup hook; workers read
+    # UVICORN_WORKERS at import to split the cores between their thread pools
+    workers = int(os.getenv("UVICORN_WORKERS", max(2, os.cpu_count() or 1)))
+    os.environ["UVICORN_WORKERS"] = str(workers)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers, loop="uvloop", http="httptools")
\ No newline at end of file
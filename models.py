@@ -21,9 +21,10 @@ class Document(Base):
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String(255), nullable=False)  # Stored filename
     original_name = Column(String(255), nullable=False)  # Original PDF name
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     upload_date = Column(DateTime(timezone=True), server_default=func.now())
     file_size = Column(Integer)  # File size in bytes
+    content_hash = Column(String(64), index=True)  # SHA-256 of the file contents
     
     # Relationship to user
     user = relationship("User", back_populates="documents")
\ No newline at end of file
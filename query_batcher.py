@@ -0,0 +1,96 @@
+# query_batcher.py
+"""
+Micro-batching and caching of query embeddings for the API.
+"""
+
+import asyncio
+from collections import OrderedDict
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+from sentence_transformers import SentenceTransformer
+from typing import List, Optional, Tuple
+from embedder import EMBEDDER
+
+# Query micro-batching: encode calls arriving within QUERY_BATCH_DELAY seconds share one forward pass
+QUERY_BATCH_SIZE = 32
+QUERY_BATCH_DELAY = 0.005
+
+# Number of distinct query strings whose embeddings are kept in memory
+QUERY_CACHE_SIZE = 4096
+
+
+class QueryBatcher:
+    """Coalesces concurrent query encodes into a single batched `encode` call.
+
+    Callers await `encode(query)`; the first query of a batch waits up to `max_delay` for
+    others to arrive, then all of them are encoded together in the threadpool. Recent
+    results are kept in an LRU so repeated queries skip the model entirely.
+    """
+
+    def __init__(self, model: SentenceTransformer = EMBEDDER, max_batch_size: int = QUERY_BATCH_SIZE,
+                 max_delay: float = QUERY_BATCH_DELAY, cache_size: int = QUERY_CACHE_SIZE):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def encode(self, query: str) -> np.ndarray:
+        """Return the normalized (1, d) float32 embedding of a query."""
+        cached = self._cache.get(query)
+        if cached is not None:
+            self._cache.move_to_end(query)
+            return cached
+
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, future))
+        return await future
+
+    async def close(self):
+        """Stop the batching task."""
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    def _encode_batch(self, queries: List[str]) -> np.ndarray:
+        return self.model.encode(
+            queries, batch_size=self.max_batch_size, convert_to_numpy=True, normalize_embeddings=True
+        )
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[Tuple[str, asyncio.Future]] = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            queries = list(dict.fromkeys(query for query, _ in batch))
+            try:
+                embeddings = await run_in_threadpool(self._encode_batch, queries)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            results = {query: embeddings[i:i + 1] for i, query in enumerate(queries)}
+            for query, embedding in results.items():
+                self._cache[query] = embedding
+                self._cache.move_to_end(query)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            for query, future in batch:
+                if not future.done():
+                    future.set_result(results[query])
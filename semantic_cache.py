@@ -0,0 +1,92 @@
+# semantic_cache.py
+"""
+Answer cache for /search: exact query matches plus near-duplicate (paraphrased) queries
+found by cosine similarity of their embeddings.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import faiss
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+# Cached answers are reused for queries at least this similar (cosine of normalized embeddings)
+SIMILARITY_THRESHOLD = 0.97
+CACHE_MAX_ENTRIES = 1024
+CACHE_TTL_SECONDS = 3600
+
+
+class SemanticCache:
+    """LRU + TTL cache of LLM answers keyed on (scope, query).
+
+    The scope identifies what the answer was computed over (e.g. user and document), and a
+    cached answer is only ever returned for the same scope.
+    """
+
+    def __init__(self, dimension: int, threshold: float = SIMILARITY_THRESHOLD,
+                 max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: float = CACHE_TTL_SECONDS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        # Query embeddings, under the same ids as the entries
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        # entry id -> (scope, query, expires_at, payload), oldest first
+        self.entries: "OrderedDict[int, Tuple[Hashable, str, float, Dict[str, Any]]]" = OrderedDict()
+        self.exact: Dict[Tuple[Hashable, str], int] = {}
+        self.scope_ids: Dict[Hashable, Set[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def get(self, scope: Hashable, query: str, query_embedding: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Return the cached payload for this query (or a near-identical one) in scope, if any."""
+        with self._lock:
+            entry_id = self.exact.get((scope, query))
+            if entry_id is None:
+                entry_id = self._nearest(scope, query_embedding)
+            if entry_id is None:
+                return None
+
+            _, _, expires_at, payload = self.entries[entry_id]
+            if expires_at < time.monotonic():
+                self._remove(entry_id)
+                return None
+            self.entries.move_to_end(entry_id)
+            return payload
+
+    def add(self, scope: Hashable, query: str, query_embedding: np.ndarray, payload: Dict[str, Any]):
+        """Cache the payload computed for a query, evicting the least recently used entries."""
+        with self._lock:
+            previous_id = self.exact.get((scope, query))
+            if previous_id is not None:
+                self._remove(previous_id)
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self.index.add_with_ids(query_embedding, np.array([entry_id], dtype='int64'))
+            self.entries[entry_id] = (scope, query, time.monotonic() + self.ttl_seconds, payload)
+            self.exact[(scope, query)] = entry_id
+            self.scope_ids.setdefault(scope, set()).add(entry_id)
+
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def _nearest(self, scope: Hashable, query_embedding: np.ndarray) -> Optional[int]:
+        """Find the most similar cached query in scope above the similarity threshold."""
+        ids = self.scope_ids.get(scope)
+        if not ids:
+            return None
+        selector = faiss.IDSelectorBatch(np.fromiter(ids, dtype='int64', count=len(ids)))
+        scores, indices = self.index.search(query_embedding, 1, params=faiss.SearchParameters(sel=selector))
+        if indices[0][0] < 0 or scores[0][0] < self.threshold:
+            return None
+        return int(indices[0][0])
+
+    def _remove(self, entry_id: int):
+        scope, query, _, _ = self.entries.pop(entry_id)
+        del self.exact[(scope, query)]
+        self.scope_ids[scope].discard(entry_id)
+        if not self.scope_ids[scope]:
+            del self.scope_ids[scope]
+        self.index.remove_ids(np.array([entry_id], dtype='int64'))
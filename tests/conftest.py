@@ -0,0 +1,9 @@
+# conftest.py
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The index tests feed precomputed embeddings, so don't load the sentence embedding model
+sys.modules.setdefault("embedder", types.SimpleNamespace(EMBEDDER=None, THREADS_PER_WORKER=1))
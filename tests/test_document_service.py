@@ -0,0 +1,117 @@
+# test_document_service.py
+import numpy as np
+import pyarrow as pa
+import faiss
+
+import document_service
+from document_service import METADATA_SCHEMA, DocumentProcessor
+
+
+def _random_embeddings(n: int, d: int = 384, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((n, d)).astype('float32')
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def _add_document(processor: DocumentProcessor, document_id: int, embeddings: np.ndarray):
+    table = pa.Table.from_pylist([
+        {"document_id": document_id, "page": 1, "chunk_index": i, "pdf_name": f"{document_id}.pdf",
+         "content": f"chunk {i}"}
+        for i in range(len(embeddings))
+    ], schema=METADATA_SCHEMA)
+    with processor._lock, processor._store_lock():
+        processor._sync()
+        processor._append_chunks(document_id, embeddings, table)
+
+
+def test_default_index_trains_merges_and_reopens(tmp_path):
+    index_path = str(tmp_path / "pdf_index.faiss")
+    metadata_path = str(tmp_path / "metadata.parquet")
+    processor = DocumentProcessor(index_path, metadata_path)
+    assert document_service.FAISS_INDEX_FACTORY == "IVF{nlist},PQ16"
+
+    # Enough vectors to train the IVF index, which merges the delta and reopens the main index mapped
+    embeddings = _random_embeddings(document_service.min_train_size(processor.index))
+    _add_document(processor, 1, embeddings)
+    assert isinstance(processor.index, faiss.IndexIVF)
+    assert processor.index.ntotal == len(embeddings)
+    assert processor.delta.ntotal == 0
+
+    reopened = DocumentProcessor(index_path, metadata_path)
+    assert isinstance(reopened.index, faiss.IndexIVF)
+    assert reopened.ntotal == len(embeddings)
+    results = reopened.search("", query_embedding=embeddings[:1], k=3)
+    assert results[0]["content"] == "chunk 0"
+
+
+def test_ivf_index_is_retrained_as_the_corpus_grows(tmp_path, monkeypatch):
+    monkeypatch.setattr(document_service, "IVF_RETRAIN_FACTOR", 1.5)
+    processor = DocumentProcessor(str(tmp_path / "pdf_index.faiss"), str(tmp_path / "metadata.parquet"))
+    first = _random_embeddings(document_service.min_train_size(processor.index))
+    _add_document(processor, 1, first)
+    assert processor.index.nlist == 100
+
+    # The next merge finds N >= 1.5 * nlist^2 and retrains with nlist = sqrt(N)
+    second = _random_embeddings(document_service.DELTA_MERGE_SIZE, seed=1)
+    _add_document(processor, 2, second)
+    assert processor.index.nlist == int(np.sqrt(len(first) + len(second)))
+    assert processor.index.ntotal == len(first) + len(second)
+    assert processor.delta.ntotal == 0
+    results = processor.search("", document_ids=[2], query_embedding=second[:1], k=1)
+    assert results[0]["document_id"] == 2 and results[0]["content"] == "chunk 0"
+
+
+def test_small_scoped_search_returns_k_results(tmp_path):
+    processor = DocumentProcessor(str(tmp_path / "pdf_index.faiss"), str(tmp_path / "metadata.parquet"))
+    _add_document(processor, 1, _random_embeddings(document_service.min_train_size(processor.index)))
+    small = _random_embeddings(3, seed=1)
+    _add_document(processor, 2, small)
+    processor.flush()
+    assert processor.delta.ntotal == 0
+
+    # A random query is unlikely to probe the lists holding document 2's vectors
+    query = _random_embeddings(1, seed=2)
+    results = processor.search("", document_ids=[2], query_embedding=query, k=3)
+    assert sorted(result["content"] for result in results) == ["chunk 0", "chunk 1", "chunk 2"]
+    assert all(result["document_id"] == 2 for result in results)
+
+
+def test_legacy_l2_index_migration_keeps_exact_vectors(tmp_path):
+    index_path = str(tmp_path / "pdf_index.faiss")
+    metadata_path = str(tmp_path / "metadata.parquet")
+    vectors = np.random.default_rng(0).standard_normal((document_service.MIN_TRAIN_SIZE, 384)).astype('float32')
+    legacy = faiss.IndexFlatL2(384)
+    legacy.add(vectors)
+    faiss.write_index(legacy, index_path)
+    document_service.save_metadata(pa.Table.from_pylist([
+        {"document_id": 1, "page": 1, "chunk_index": i, "pdf_name": "1.pdf", "content": f"chunk {i}"}
+        for i in range(len(vectors))
+    ], schema=METADATA_SCHEMA), metadata_path)
+
+    processor = DocumentProcessor(index_path, metadata_path)
+    assert processor.index.metric_type == faiss.METRIC_INNER_PRODUCT
+    assert processor.index.ntotal == len(vectors)
+    faiss.normalize_L2(vectors)
+    np.testing.assert_allclose(processor.vectors, vectors, atol=1e-6)
+
+
+def test_other_workers_pick_up_new_chunks_without_reloading_the_main_index(tmp_path):
+    paths = (str(tmp_path / "pdf_index.faiss"), str(tmp_path / "metadata.parquet"))
+    writer = DocumentProcessor(*paths)
+    _add_document(writer, 1, _random_embeddings(document_service.min_train_size(writer.index)))
+    reader = DocumentProcessor(*paths)
+    main_index = reader.index
+
+    embeddings = _random_embeddings(5, seed=1)
+    _add_document(writer, 2, embeddings)
+    results = reader.search("", document_ids=[2], query_embedding=embeddings[:1], k=5)
+    assert reader.index is main_index
+    assert reader.ntotal == writer.ntotal
+    assert len(results) == 5 and results[0]["content"] == "chunk 0"
+    np.testing.assert_array_equal(reader.doc_to_ids[2], writer.doc_to_ids[2])
+
+    # A merge rewrites the main index, which the reader then reloads
+    writer.flush()
+    reader.search("", query_embedding=embeddings[:1], k=1)
+    assert reader.index is not main_index
+    assert reader.index.ntotal == writer.index.ntotal and reader.delta.ntotal == 0